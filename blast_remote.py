@@ -3,19 +3,85 @@
 blast_remote.py
 Run remote blastn / megablast, save TSV, then convert to XLSX.
 
-(python >=3.8, pandas & openpyxl required for the Excel step)
+(python >=3.9, openpyxl required for the Excel step, requests for --rest;
+ pyexcelerate or xlsxwriter are used instead when installed — both are faster;
+ polars or pyarrow, when installed, parse the TSV)
 Author: Kimhun Tuntikawinwong
 """
-import argparse, os, random, subprocess, time
+import argparse, csv, os, random, re, subprocess, sys, threading, time
 from pathlib import Path
 import datetime
-import pandas as pd     
+import openpyxl
+
+try:                                    # optional fast XLSX writer
+    import pyexcelerate
+except ImportError:
+    pyexcelerate = None
+try:                                    # optional streaming XLSX writer
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+try:                                    # optional fast TSV parsers
+    import polars as pl
+except ImportError:
+    pl = None
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pacsv
+except ImportError:
+    pa = pacsv = None
+try:                                    # optional keep-alive HTTP client (--rest)
+    import requests
+    from requests.adapters import HTTPAdapter
+except ImportError:
+    requests = None
+
+OUTFMT = (
+    "6 qseqid saccver "      # query / subject IDs
+    "qcovs "                # Query Cover (sum of all HSPs, %)
+    "pident length mismatch gapopen "
+    "qstart qend sstart send "
+    "evalue "
+    "bitscore "             # Max Score  (bit-score of the best HSP)
+    "score "                # Total Score (raw score of the best HSP)
+    "qcovhsp "              # coverage of this *HSP* (%), optional
+    "qlen slen "            # Acc. Len  ≈ subject length (and query length)
+    "staxids sscinames sskingdoms")
+
+# column headers for the OUTFMT fields, same order
+BLAST_COLS = [
+    "query_seq_id","subject_seq_id","query_coverage","percent_identity","length","mismatch","gapopen",
+    "query_start","query_end","subject_start","send","evalue","bitscore","score",
+    "qcovhsp","query_length","subject_length(Acc. Len)","staxids","sscinames","sskingdoms"
+]
+# pandas dtypes for BLAST_COLS: no type inference, IDs stay text
+BLAST_DTYPES = {
+    "query_seq_id": "string", "subject_seq_id": "string",
+    "query_coverage": "float64", "percent_identity": "float64",
+    "length": "int64", "mismatch": "int64", "gapopen": "int64",
+    "query_start": "int64", "query_end": "int64",
+    "subject_start": "int64", "send": "int64",
+    "evalue": "float64", "bitscore": "float64", "score": "int64",
+    "qcovhsp": "float64", "query_length": "int64",
+    "subject_length(Acc. Len)": "int64",
+    "staxids": "string", "sscinames": "string", "sskingdoms": "string",
+}
+# columns kept as text even when they look numeric (IDs, "9606;10090" …)
+TEXT_COLS = tuple(c for c, t in BLAST_DTYPES.items() if t == "string")
+
+class BlastError(RuntimeError):
+    """Raised by :func:`run_one` when BLAST fails or returns no results."""
 
 # ---------------------------------------------------------------------
-def parse_args():
+def parse_args(argv=None):
     """
     Parse the command-line interface for *blast_remote.py*.
 
+    Parameters
+    ----------
+    argv : list[str], optional
+        Arguments to parse (default: ``sys.argv[1:]``).
+
     Returns
     -------
     argparse.Namespace
@@ -42,7 +108,12 @@ def parse_args():
     p.add_argument("--sleep", type=int, default=10,
                     metavar="Delay (sec)",
                     help="delay (s) between jobs")
-    return p.parse_args()
+    p.add_argument("--no_xlsx", action="store_true",
+                   help="write the TSV only, skip the Excel conversion")
+    p.add_argument("--rest", action="store_true",
+                   help="submit through NCBI's BLAST URL API on a keep-alive "
+                   "session instead of `blastn -remote` (needs requests)")
+    return p.parse_args(argv)
 
 # ---------------------------------------------------------------------
 def auto_name(query: Path, outdir: Path, filter_name: str) -> Path:
@@ -75,10 +146,82 @@ def auto_name(query: Path, outdir: Path, filter_name: str) -> Path:
     else:
         return outdir / f"{base}_{ts}.tsv"
 # ---------------------------------------------------------------------
+def _to_number(value: str):
+    """
+    Return *value* as ``int`` / ``float`` when it looks numeric, else as-is.
+
+    Keeps numeric BLAST columns (e-value, bitscore …) as real numbers in
+    Excel instead of text cells.
+    """
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+def _iter_tsv_rows(tsv: Path):
+    """
+    Yield the rows of a BLAST TSV one by one, numeric fields converted.
+
+    The parser is the first one installed of *polars* (a release with
+    ``LazyFrame.collect_batches``) and *pyarrow*, both multi-threaded and
+    typed from :data:`BLAST_DTYPES`; otherwise the ``csv`` module is used.
+    Every parser reads the file block by block, so memory stays bounded.
+    """
+    if pl is not None and hasattr(pl.LazyFrame, "collect_batches"):
+        pl_types = {"string": pl.Utf8, "float64": pl.Float64, "int64": pl.Int64}
+        lf = pl.scan_csv(tsv, separator="\t", has_header=False, quote_char=None,
+                         empty_string_is_null=False,
+                         schema={c: pl_types[t] for c, t in BLAST_DTYPES.items()})
+        for df in lf.collect_batches():         # streaming engine, chunk by chunk
+            yield from df.iter_rows()
+        return
+
+    if pacsv is not None:
+        # explicit types: open_csv would infer them from the first block only
+        pa_types = {"string": pa.string(), "float64": pa.float64(), "int64": pa.int64()}
+        reader = pacsv.open_csv(
+            str(tsv),
+            read_options=pacsv.ReadOptions(column_names=BLAST_COLS),
+            parse_options=pacsv.ParseOptions(delimiter="\t", quote_char=False),
+            convert_options=pacsv.ConvertOptions(
+                column_types={c: pa_types[t] for c, t in BLAST_DTYPES.items()}))
+        for batch in reader:
+            yield from zip(*(col.to_pylist() for col in batch.columns))
+        return
+
+    text = {BLAST_COLS.index(c) for c in TEXT_COLS}
+    with tsv.open(newline="") as fh:
+        for row in csv.reader(fh, delimiter="\t", quoting=csv.QUOTE_NONE):
+            yield [v if i in text else _to_number(v) for i, v in enumerate(row)]
+
+_SAY_LOCK = threading.Lock()
+
+def _say(msg: str, query=None, stream=None) -> None:
+    """
+    Print *msg* in a single locked write, each line tagged ``[query]``.
+
+    Batch runs call :func:`run_one` from several threads; one write per
+    message keeps their progress lines from interleaving.
+    """
+    tag = f"[{query}] " if query else ""
+    text = "".join(f"{tag}{line}\n" for line in msg.split("\n"))
+    stream = stream or sys.stdout
+    with _SAY_LOCK:
+        stream.write(text)
+        stream.flush()
+
 def convert_tsv_to_xlsx(tsv: Path):
     """
     Load a BLAST *outfmt 6* TSV, add column headers, and save as Excel.
 
+    The TSV is streamed straight into the workbook (no DataFrame). The
+    writer is the first one installed of *pyexcelerate*, *xlsxwriter*
+    (constant-memory mode) and openpyxl (write-only mode).
+
     Parameters
     ----------
     tsv : pathlib.Path
@@ -91,19 +234,33 @@ def convert_tsv_to_xlsx(tsv: Path):
 
     Notes
     -----
-    The column list (`cols`) must match the fields requested in the
-    ``-outfmt`` string, **in the same order**; otherwise Pandas will
-    mis-align the data.
-    """
-    cols = [
-        "query_seq_id","subject_seq_id","query_coverage","percent_identity","length","mismatch","gapopen",
-        "query_start","query_end","subject_start","send","evalue","bitscore","score",
-        "qcovhsp","query_length","subject_length(Acc. Len)","staxids","sscinames","sskingdoms"
-    ]
-    df = pd.read_csv(tsv, sep="\t", header=None, names=cols)
+    The column list (`BLAST_COLS`) must match the fields requested in the
+    ``-outfmt`` string, **in the same order**; otherwise the columns will
+    be mis-aligned.
+    """
+    cols = BLAST_COLS
     xlsx = tsv.with_suffix(".xlsx")
-    df.to_excel(xlsx, index=False)
-    print(f"Create excel: {xlsx.name}")
+    if pyexcelerate is not None:
+        wb = pyexcelerate.Workbook()
+        wb.new_sheet("BLAST", data=[cols] + list(_iter_tsv_rows(tsv)))
+        wb.save(str(xlsx))
+    elif xlsxwriter is not None:
+        # constant_memory: each row is flushed to disk once written
+        wb = xlsxwriter.Workbook(str(xlsx), {"constant_memory": True})
+        ws = wb.add_worksheet("BLAST")
+        ws.write_row(0, 0, cols)
+        for i, row in enumerate(_iter_tsv_rows(tsv), start=1):
+            ws.write_row(i, 0, row)
+        wb.close()
+    else:
+        # write-only: rows go straight to the XML stream (lxml if installed)
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet("BLAST")
+        ws.append(cols)
+        for row in _iter_tsv_rows(tsv):
+            ws.append(row)
+        wb.save(xlsx)
+    _say(f"Create excel: {xlsx.name}")
     return xlsx
 # -------------------------------------------------------
 def warn_if_short(query_fa: Path,
@@ -139,98 +296,241 @@ def warn_if_short(query_fa: Path,
     if requested_task == "blastn-short":
         return                                     # user already chose it
 
-    # count only the first sequence (fast)
+    # count only the first sequence (fast): one 4 KiB read covers any
+    # defline + threshold, more is read only for very long deflines
     length = 0
-    with query_fa.open() as fh:
-        for line in fh:
-            if line.startswith(">"):
-                if length:                         # we’ve finished 1st record
-                    break
-                continue
-            length += len(line.strip())
-            if length > threshold:                 # long enough, stop early
+    with query_fa.open("rb") as fh:
+        buf = fh.read(4096)
+        while buf and not buf.lstrip():            # skip leading blank lines
+            buf = fh.read(4096)
+        buf = buf.lstrip()
+        in_defline = buf[:1] == b">"
+        while buf:
+            if in_defline:
+                nl = buf.find(b"\n")
+                if nl == -1:
+                    buf = fh.read(4096)
+                    continue
+                buf, in_defline = buf[nl + 1:], False
+            end = buf.find(b">")                   # next record, if any
+            body = buf if end == -1 else buf[:end]
+            length += len(body) - body.count(b"\n") - body.count(b"\r")
+            if end != -1 or length > threshold:    # done / long enough
                 break
+            buf = fh.read(4096)
 
     if length <= threshold:
-        print(
+        _say(
             f">  Query length = {length} bp; "
-            "for sequences ≤ {threshold} bp NCBI recommends `-task blastn-short`.\n"
+            f"for sequences ≤ {threshold} bp NCBI recommends `-task blastn-short`.\n"
             f">   You requested `-task {requested_task}`. "
             "If you want optimal sensitivity for very short probes/primers, "
-            "consider rerunning with `-t blastn-short`."
-        )
+            "consider rerunning with `-t blastn-short`.",
+            query_fa.name)
 # -------------------------------------------------------
-def main():
-    a = parse_args()
+QBLAST_URL = "https://blast.ncbi.nlm.nih.gov/Blast.cgi"
+
+# extra "Put" parameters reproducing the blastn -task presets
+QBLAST_TASK_PARAMS = {
+    "blastn":       {},
+    "megablast":    {"MEGABLAST": "on"},
+    "dc-megablast": {"SERVICE": "dmegablast"},
+    "blastn-short": {"WORD_SIZE": "7", "NUCL_REWARD": "1",
+                     "NUCL_PENALTY": "-3", "GAPCOSTS": "5 2"},
+}
+
+# one pooled session per process: TCP + TLS are reused across polls,
+# queries and batch worker threads
+if requests is not None:
+    SESSION = requests.Session()
+    SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+else:
+    SESSION = None
+
+def _qblast(method: str, **kwargs) -> str:
+    """
+    Send one request to the QBlast endpoint and return the response text.
 
-    query  = Path(a.query).expanduser().resolve()
+    Raises
+    ------
+    BlastError
+        On any network or HTTP error.
+    """
+    try:
+        r = SESSION.request(method, QBLAST_URL, timeout=120, **kwargs)
+        r.raise_for_status()
+    except requests.RequestException as e:
+        raise BlastError(f"QBlast request failed: {e}") from e
+    return r.text
+
+def qblast_submit(query: Path, db: str, task: str, entrez_query=None):
+    """
+    Submit *query* to NCBI's BLAST URL API (``CMD=Put``).
+
+    Parameters
+    ----------
+    query : pathlib.Path
+        FASTA file containing ONE query sequence.
+    db, task : str
+        BLAST database and task, as for ``blastn``.
+    entrez_query : str, optional
+        Entrez filter (e.g. ``"txid1762[Organism]"``).
+
+    Returns
+    -------
+    tuple[str, int]
+        The request ID (RID) and NCBI's estimated run time in seconds.
+    """
+    data = {"CMD": "Put", "PROGRAM": "blastn", "DATABASE": db,
+            "QUERY": query.read_text(), "HITLIST_SIZE": "200",
+            "TOOL": "BatchBlast", **QBLAST_TASK_PARAMS[task]}
+    if entrez_query:
+        data["ENTREZ_QUERY"] = entrez_query
+    text = _qblast("POST", data=data)
+    rid = re.search(r"^\s*RID = (\S+)", text, re.M)
+    rtoe = re.search(r"^\s*RTOE = (\d+)", text, re.M)
+    if rid is None:
+        raise BlastError("QBlast did not return a request ID (RID)")
+    return rid.group(1), int(rtoe.group(1)) if rtoe else 30
+
+def qblast_wait(rid: str, rtoe: int, poll: int = 60) -> None:
+    """
+    Block until QBlast search *rid* is finished.
+
+    NCBI asks clients not to poll one RID more than once a minute, so the
+    status is checked after *rtoe* seconds and then every *poll* seconds.
+
+    Raises
+    ------
+    BlastError
+        If the search fails or the RID expires.
+    """
+    time.sleep(rtoe)
+    while True:
+        text = _qblast("GET", params={"CMD": "Get", "RID": rid,
+                                      "FORMAT_OBJECT": "SearchInfo"})
+        status = re.search(r"Status=(\w+)", text)
+        status = status.group(1) if status else "UNKNOWN"
+        if status == "READY":
+            return
+        if status != "WAITING":
+            raise BlastError(f"QBlast search {rid} ended with status {status}")
+        time.sleep(poll)
+
+def run_one(query, db="core_nt", task="blastn", outdir=".", outfile="",
+            filter=None, filter_name=None, sleep=10, no_xlsx=False,
+            rest=False) -> Path:
+    """
+    Run one remote BLAST search, write the TSV and (optionally) the XLSX.
+
+    The keyword arguments mirror the command-line options, so batch callers
+    can run many queries in one interpreter instead of one process each.
+
+    Parameters
+    ----------
+    query : str or pathlib.Path
+        FASTA file containing ONE query sequence.
+    db, task, outdir, outfile, filter, filter_name, sleep, no_xlsx, rest
+        Same meaning as the matching command-line options. With *rest*
+        the search goes through :func:`qblast_submit` / :func:`qblast_wait`
+        and ``blast_formatter -rid`` writes the TSV.
+
+    Returns
+    -------
+    pathlib.Path
+        Path of the written *.tsv* file.
+
+    Raises
+    ------
+    BlastError
+        If BLAST fails or produces no results.
+    """
+    if rest and requests is None:
+        raise BlastError("--rest needs the 'requests' package")
+
+    query  = Path(query).expanduser().resolve()
     if not query.is_file():
         raise FileNotFoundError(query)
-    warn_if_short(query, a.task)
-    outdir = Path(a.outdir).expanduser().resolve()
+    warn_if_short(query, task)
+    outdir = Path(outdir).expanduser().resolve()
     outdir.mkdir(parents=True, exist_ok=True)
 
-    tsv_path = outdir / a.outfile if a.outfile else auto_name(query, outdir, a.filter_name)
+    tsv_path = outdir / outfile if outfile else auto_name(query, outdir, filter_name)
 
     # Where BLAST looks for taxdb.* if you have a local copy (not nessecary for remote BLAST)
     os.environ.setdefault("BLASTDB", str(Path.home() / "blastdb"))
 
     cmd = [
         "blastn",
-        "-task", a.task,
+        "-task", task,
         "-query", str(query),
-        "-db", a.db,
+        "-db", db,
         "-remote",
         "-max_target_seqs", "200",
-        "-outfmt", 
-        (
-        "6 qseqid saccver "      # query / subject IDs
-        "qcovs "                # Query Cover (sum of all HSPs, %)
-        "pident length mismatch gapopen "
-        "qstart qend sstart send "
-        "evalue "
-        "bitscore "             # Max Score  (bit-score of the best HSP)
-        "score "                # Total Score (raw score of the best HSP)
-        "qcovhsp "              # coverage of this *HSP* (%), optional
-        "qlen slen "            # Acc. Len  ≈ subject length (and query length)
-        "staxids sscinames sskingdoms"),
+        "-outfmt", OUTFMT,
         "-out", str(tsv_path),
     ]
 
-    if a.filter or a.filter == "":                      
-        cmd.extend(["-entrez_query", a.filter])
+    if filter or filter == "":                      
+        cmd.extend(["-entrez_query", filter])
 
-    print("> Running BLAST ⇒\n  " + "   ".join(cmd) + "\n")
     t0 = time.perf_counter()
-    print(f"> Waiting for BLAST result ...")
-    res = subprocess.run(cmd, capture_output=True, text=True)
+    if rest:
+        rid, rtoe = qblast_submit(query, db, task, filter)
+        _say(f"> Submitted to QBlast, RID {rid} (estimated {rtoe}s)", query.name)
+        _say(f"> Waiting for BLAST result ...", query.name)
+        qblast_wait(rid, rtoe)
+        cmd = ["blast_formatter", "-rid", rid, "-max_target_seqs", "200",
+               "-outfmt", OUTFMT, "-out", str(tsv_path)]
+
+    _say("> Running BLAST ⇒\n  " + "   ".join(cmd) + "\n", query.name)
+    if not rest:
+        _say(f"> Waiting for BLAST result ...", query.name)
+    # stream BLAST's diagnostics as they arrive; keep only the last line
+    # for the error message instead of buffering the whole stderr
+    last_err = ""
+    with subprocess.Popen(cmd, stderr=subprocess.PIPE, text=True) as proc:
+        for line in proc.stderr:
+            _say(line.rstrip("\n"), query.name, sys.stderr)
+            last_err = line.strip() or last_err
+    returncode = proc.returncode
     t1 = time.perf_counter()                    
     elapsed_sec = t1 - t0                        # float, seconds
     elapsed_hms = str(datetime.timedelta(seconds=int(elapsed_sec)))
-    print(f"> Receive BLAST result! done in {elapsed_hms}")
-    print(f"> Query time: {elapsed_hms}")
+    _say(f"> Receive BLAST result! done in {elapsed_hms}", query.name)
+    _say(f"> Query time: {elapsed_hms}", query.name)
 
 
-    if res.returncode != 0:
-        print(res.stderr)
-        raise SystemExit(f"BLAST failed (exit {res.returncode})")
+    if returncode != 0:
+        raise BlastError(f"BLAST failed (exit {returncode})"
+                         + (f": {last_err}" if last_err else ""))
 
     # ── sanity-check the output file ────────────────────────────────
     if not tsv_path.exists() or tsv_path.stat().st_size == 0:
-        raise SystemExit(
+        raise BlastError(
             "BLAST finished but produced no results — "
             "check your query and/or filter string."
         )
 
-    print(f"> TSV written → {tsv_path.name}  ({tsv_path.stat().st_size} bytes)")
+    _say(f"> TSV written → {tsv_path.name}  ({tsv_path.stat().st_size} bytes)",
+         query.name)
 
     #convert to excel
-    convert_tsv_to_xlsx(tsv_path)
+    if not no_xlsx:
+        convert_tsv_to_xlsx(tsv_path)
 
     # polite back-off
 
-    print(f"Sleeping {a.sleep}s …")
-    time.sleep(a.sleep)
+    _say(f"Sleeping {sleep}s …", query.name)
+    time.sleep(sleep)
+    return tsv_path
+
+def main(argv=None):
+    a = parse_args(argv)
+    try:
+        run_one(**vars(a))
+    except BlastError as e:
+        raise SystemExit(str(e))
 
 # ---------------------------------------------------------------------
 if __name__ == "__main__":
@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 """
 run_batch_blast.py
-Call blast_remote.py sequentially for many query FASTA files.
+Run blast_remote for many query FASTA files, a few jobs at a time.
 
-> skips files already processed (xlsx present)
+> skips files already processed (xlsx present, or tsv with --combined_xlsx)
+> runs up to --jobs BLAST searches concurrently (default 3)
 > logs every step
 > back off atleast 10 sec for each query
 
@@ -11,8 +12,12 @@ Author: Kimhun Tuntikawinwong
 """
 
 from pathlib import Path
-from textwrap import wrap
-import subprocess, sys, time, datetime, random, logging, argparse
+from concurrent.futures import ThreadPoolExecutor, wait
+import csv, os, sys, time, datetime, random, logging, argparse, re
+import pandas as pd
+
+import blast_remote
+from blast_remote import BLAST_COLS, BLAST_DTYPES
 
 # ─── command-line options ──────────────────────────────────────────────
 def get_args():
@@ -26,20 +31,22 @@ def get_args():
 
         * **input_dir** – folder containing FASTA files  
         * **out_dir** – destination for *.tsv / .xlsx*  
-        * **blast_script** – path to *blast_remote.py*  
         * **include** – list[str] keywords for filename whitelist  
         * **filter** – Entrez query string (or *None*)  
         * **filter_name** – short human-readable label for the filter
         * **task** algorithmn to use
         * **database** database to use
         * **sleep** – int pause in seconds
+        * **jobs** – int number of BLAST jobs run concurrently
+        * **combined_xlsx** – one workbook for the whole batch (or *None*)
+        * **rest** – submit via NCBI's BLAST URL API (keep-alive session)
+        * **blast_script** – deprecated and ignored (jobs call
+          :func:`blast_remote.run_one` directly)
     """
     ap = argparse.ArgumentParser(
         description="Batch wrapper around blast_remote.py")
     ap.add_argument("input_dir", metavar="Input dir", help="folder with *.fa / *.fna / *.fasta")
     ap.add_argument("out_dir", metavar="Output dir", help="folder to write .tsv / .xlsx results")
-    ap.add_argument("--blast_script", default="blast_remote.py",
-                    help="path to blast_remote.py (default: same folder)")
     ap.add_argument("--include",nargs="*",             # 0, 1, or many strings
                     metavar="Keyword to Include",help="whitelist of keyword; keep FASTA whose *filename* contains "
                     "any Keywords (case-insensitive). If omitted, every FASTA is kept."
@@ -57,7 +64,24 @@ def get_args():
     ap.add_argument("--sleep", type=int, default=10,
                     metavar="Delay (sec)",
                     help="delay (s) between jobs")
-    return ap.parse_args()
+    ap.add_argument("--jobs", type=int, default=3,
+                    metavar="N",
+                    help="number of BLAST jobs run concurrently (default: 3; "
+                    "NCBI asks for no more than a few at once)")
+    ap.add_argument("--combined_xlsx", "--combined-xlsx", default=None,
+                    metavar="PATH",
+                    help="write every result into ONE workbook (a sheet per "
+                    "query) instead of one .xlsx per job")
+    ap.add_argument("--rest", action="store_true",
+                    help="submit through NCBI's BLAST URL API; one keep-alive "
+                    "HTTP session is shared by all jobs (needs requests)")
+    ap.add_argument("--blast_script", default=None,
+                    help="deprecated, ignored: blast_remote is imported "
+                    "and run in-process")
+    args = ap.parse_args()
+    if args.jobs < 1:
+        ap.error("--jobs must be at least 1")
+    return args
 
 # ─── helpers ───────────────────────────────────────────────────────────
 def human(seconds: float) -> str:
@@ -76,37 +100,185 @@ def human(seconds: float) -> str:
     """
     return str(datetime.timedelta(seconds=int(seconds)))
 
-def done_already(fasta: Path, out_dir: Path) -> bool:
+def keyword_matcher(keywords):
+    """
+    Build the filename test for the ``--include`` whitelist.
+
+    All keywords are compiled into **one** regex alternation, so each
+    filename is lower-cased and scanned once instead of once per keyword.
+
+    Parameters
+    ----------
+    keywords : list[str] or None
+        Keywords to look for (case-insensitive); *None* keeps every file.
+
+    Returns
+    -------
+    callable
+        ``match(name) -> bool``.
+    """
+    if keywords is None:
+        return lambda name: True
+    if not keywords:                             # "--include" with no keyword
+        return lambda name: False
+    patt = re.compile("|".join(map(re.escape, (kw.lower() for kw in keywords))))
+    return lambda name: patt.search(name.lower()) is not None
+
+def result_stem_pattern(filter_name=None):
+    """
+    Compile the pattern of the result names :func:`blast_remote.auto_name`
+    produces: ``<stem>_vs_<filter_name>_<YYYYMMDD_HHMMSS>`` when
+    *filter_name* is set, otherwise ``<stem>_<YYYYMMDD_HHMMSS>``.
+
+    Group 1 is the query stem; a stem may itself contain ``_vs_``.
+    """
+    tail = f"_vs_{re.escape(filter_name)}" if filter_name else ""
+    return re.compile(rf"^(.+){tail}_\d{{8}}_\d{{6}}$")
+
+def find_results(out_dir: Path, suffix: str = ".xlsx",
+                 filter_name=None) -> dict:
+    """
+    Map every query stem to its newest result file in *out_dir*.
+
+    Only names matching :func:`result_stem_pattern` count; anything else
+    in *out_dir* (e.g. a user's ``all.xlsx``) is ignored, as are empty
+    files (BLAST run without hits).
+
+    Parameters
+    ----------
+    out_dir : pathlib.Path
+        Output folder that may already contain results.
+    suffix : str, optional
+        Result extension to look for (default ``".xlsx"``).
+    filter_name : str, optional
+        The ``--filter_name`` of this batch (results are named after it).
+
+    Returns
+    -------
+    dict[str, Path]
+        ``{query stem: result path}``, newest timestamp wins.
+    """
+    pattern = result_stem_pattern(filter_name)
+    results = {}
+    with os.scandir(out_dir) as entries:         # names come with getdents
+        # oldest → newest by the trailing YYYYMMDD_HHMMSS of the stem
+        for e in sorted(entries, key=lambda e: os.path.splitext(e.name)[0][-15:]):
+            stem, ext = os.path.splitext(e.name)
+            m = pattern.match(stem) if ext == suffix else None
+            if m and e.stat().st_size:
+                results[m.group(1)] = Path(e.path)
+    return results
+
+def done_stems(out_dir: Path, suffix: str = ".xlsx", filter_name=None) -> set:
+    """
+    Collect the query stems that already have a result.
+
+    *out_dir* is scanned **once**; the returned set makes every later
+    :func:`done_already` check O(1).
+
+    Parameters
+    ----------
+    out_dir : pathlib.Path
+        Output folder that may already contain results.
+    suffix : str, optional
+        Result extension that marks a job as done (default ``".xlsx"``).
+    filter_name : str, optional
+        The ``--filter_name`` of this batch.
+
+    Returns
+    -------
+    set[str]
+        Query stems recovered from the result file names.
+    """
+    return set(find_results(out_dir, suffix, filter_name))
+
+def sheet_name(stem: str, used: set) -> str:
+    """
+    Turn *stem* into a unique, valid Excel sheet name (≤ 31 chars).
+
+    Parameters
+    ----------
+    stem : str
+        Query stem the sheet is named after.
+    used : set[str]
+        Names already taken in the workbook; the result is added to it.
+
+    Returns
+    -------
+    str
+        Sheet name, suffixed with ``~2``, ``~3`` … on collisions.
+    """
+    # Excel also rejects names that start or end with an apostrophe
+    base = re.sub(r"[\[\]:*?/\\]", "_", stem)[:31].strip("'") or "Sheet"
+    name, n = base, 1
+    while name.lower() in used:                  # Excel ignores case
+        n += 1
+        name = f"{base[:31 - len(str(n)) - 1]}~{n}"
+    used.add(name.lower())
+    return name
+
+def write_combined_xlsx(sheets: list, xlsx: Path) -> Path:
+    """
+    Write several BLAST TSVs into one workbook, one sheet per query.
+
+    The workbook is opened and finalised **once** instead of once per job.
+
+    Parameters
+    ----------
+    sheets : list[tuple[str, Path]]
+        ``(sheet name, TSV path)`` pairs, in sheet order.
+    xlsx : pathlib.Path
+        Destination Excel file.
+
+    Returns
+    -------
+    pathlib.Path
+        *xlsx*, for convenience.
+    """
+    with pd.ExcelWriter(xlsx, engine="xlsxwriter") as xw:
+        for name, tsv in sheets:
+            # same cell values as convert_tsv_to_xlsx: "N/A" stays text,
+            # quote characters are data
+            df = pd.read_csv(tsv, sep="\t", header=None, names=BLAST_COLS,
+                             dtype=BLAST_DTYPES, engine="c", low_memory=False,
+                             keep_default_na=False, na_values=[],
+                             quoting=csv.QUOTE_NONE,
+                             float_precision="round_trip")  # 1e-50 stays 1e-50
+            df.to_excel(xw, sheet_name=name, index=False)
+    return xlsx
+
+def done_already(fasta: Path, stems: set) -> bool:
     """
     Check whether this FASTA has been processed before.
 
-    The rule is: if any *.xlsx* in *out_dir* starts with the same **stem**
-    (basename without extension) as *fasta*, we consider the job done.
+    The rule is: if an *.xlsx* in the output folder was named after the
+    same **stem** (basename without extension) as *fasta*, we consider the
+    job done.
 
     Parameters
     ----------
     fasta : pathlib.Path
         Query FASTA file.
-    out_dir : pathlib.Path
-        Output folder that may already contain results.
+    stems : set[str]
+        Stems of finished jobs, as returned by :func:`done_stems`.
 
     Returns
     -------
     bool
         ``True`` if a matching Excel file exists, else ``False``.
     """
-    stem = fasta.stem
-    return any(p.name.startswith(stem) and p.suffix == ".xlsx"
-               for p in out_dir.iterdir())
+    return fasta.stem.split(".")[0] in stems
 
-def split_multifasta(fasta: Path, out_folder: Path, line_width: int = 70,):
+def split_multifasta(fasta: Path, out_folder: Path, line_width: int = 70,
+                     rewrap: bool = False):
     """
     Split a multi-record FASTA into individual one-record files.
 
     If *fasta* contains only a single header, the same path is returned
     unchanged. Otherwise each record is written to  
     ``<out_folder>/<stem>_<idx>.fasta`` and a list of those paths is
-    returned.
+    returned. If ``<stem>_1.fasta`` is already present (e.g. a rerun),
+    the existing split files are returned without re-reading *fasta*.
 
     Parameters
     ----------
@@ -116,6 +288,9 @@ def split_multifasta(fasta: Path, out_folder: Path, line_width: int = 70,):
         Folder to hold the generated single-record FASTA files.
     line_width : int, optional
         Column width used when re-wrapping sequence lines (default 70).
+    rewrap : bool, optional
+        Re-wrap sequences to *line_width* columns. Off by default: BLAST+
+        accepts any line width, so records are copied verbatim.
 
     Returns
     -------
@@ -123,45 +298,66 @@ def split_multifasta(fasta: Path, out_folder: Path, line_width: int = 70,):
         List of FASTA paths that the caller should submit to BLAST.
     """
 
-    # --- quick scan to find deflines ------------------------------
-    with fasta.open() as fh:
-        headers = [i for i, line in enumerate(fh) if line.startswith(">")]
-
-    if len(headers) <= 1:                       # single-record FASTA
-        return [fasta]   
-    log = logging.getLogger("batch")
-    log.info("Detected  multiple headers in one FASTA files, splitting into %d sequences", len(headers))
+    # --- already split by an earlier run --------------------------
+    if (out_folder / f"{fasta.stem}_1.fasta").exists():
+        cached, idx = [], 1
+        while (out_folder / f"{fasta.stem}_{idx}.fasta").exists():
+            cached.append(out_folder / f"{fasta.stem}_{idx}.fasta")
+            idx += 1
+        return cached
 
-    out_folder.mkdir(parents=True, exist_ok=True) 
-    
-    # --- multi-record: split --------------------------------------
+    # --- one pass: lines are streamed to the current record's file ---
     split_files = []
-    record_idx = 0
-    seq_lines  = []
-    header     = None
-
-    def flush():
-        nonlocal record_idx, seq_lines, header
-        if header is None:
+    seq_lines  = []                             # only buffered when rewrap
+    out        = None                           # file of the current record
+    # record 1 stays "*.tmp" until the whole file is split, so an existing
+    # "<stem>_1.fasta" always means a complete split (see cache above)
+    first_tmp  = out_folder / f"{fasta.stem}_1.fasta.tmp"
+
+    def close_record():
+        nonlocal seq_lines
+        if out is None:
             return
-        record_idx += 1
-        out_path = out_folder / f"{fasta.stem}_{record_idx}.fasta"
-        with out_path.open("w") as out:
-            out.write(header)
-            for chunk in wrap("".join(seq_lines).replace("\n", ""), line_width):
-                out.write(chunk + "\n")
-        split_files.append(out_path)
-        seq_lines, header = [], None
-
-    with fasta.open() as fh:
-        for line in fh:
-            if line.startswith(">"):
-                flush()
-                header = line
-            else:
-                seq_lines.append(line.strip())
-        flush()                                 # last record
+        if rewrap:
+            seq = "".join(seq_lines)            # lines are already stripped
+            for i in range(0, len(seq), line_width):
+                out.write(seq[i:i + line_width])
+                out.write("\n")
+            seq_lines = []
+        out.close()
+
+    try:
+        with fasta.open(buffering=1 << 20) as fh:   # 1 MiB reads
+            for line in fh:
+                if line.startswith(">"):
+                    close_record()
+                    if not split_files:
+                        out_folder.mkdir(parents=True, exist_ok=True)
+                        out_path = first_tmp
+                    else:
+                        out_path = out_folder / f"{fasta.stem}_{len(split_files) + 1}.fasta"
+                    out = out_path.open("w", buffering=1 << 20)
+                    out.write(line)
+                    split_files.append(out_path)
+                elif out is None:
+                    continue                    # text before the first header
+                elif rewrap:
+                    seq_lines.append(line.strip())
+                else:
+                    out.write(line)
+            close_record()
+    finally:
+        if out is not None:
+            out.close()
+
+    if len(split_files) <= 1:                   # single-record FASTA
+        if first_tmp.exists():
+            first_tmp.unlink()
+        return [fasta]
+    split_files[0] = first_tmp.rename(out_folder / f"{fasta.stem}_1.fasta")
 
+    log = logging.getLogger("batch")
+    log.info("Detected  multiple headers in one FASTA files, split into %d sequences", len(split_files))
     return split_files
 
 # ─── main ──────────────────────────────────────────────────────────────
@@ -172,22 +368,21 @@ def main():
     1. Parse CLI arguments.  
     2. Discover FASTA files (with optional keyword whitelist).  
     3. Split any multi-record FASTA.  
-    4. Invoke *blast_remote.py* for each sequence not yet processed.  
-    5. Log progress and sleep a random interval between jobs.
+    4. Call :func:`blast_remote.run_one` for each sequence not yet processed,
+       running up to ``--jobs`` of them at once in a thread pool.  
+    5. Log progress; each job starts after a random delay so NCBI sees
+       staggered requests rather than bursts.
+    6. With ``--combined_xlsx``, gather all TSVs into one workbook.
 
     Notes
     -----
     * Logging goes both to the console **and** to a timestamped text file
       in *out_dir*.
-    * The wrapper passes ``--sleep 0 0`` to *blast_remote.py* because the
-      outer script already handles the polite back-off.
+    * Jobs run in this interpreter (no subprocess per query), so pandas,
+      openpyxl … are imported once for the whole batch.
     """
     a = get_args()
 
-    blast_script = Path(a.blast_script).expanduser().resolve()
-    if not blast_script.is_file():
-        sys.exit(f"> blast_remote.py not found: {blast_script}")
-
     in_dir  = Path(a.input_dir).expanduser().resolve()
     out_dir = Path(a.out_dir).expanduser().resolve()
     out_dir.mkdir(parents=True, exist_ok=True)
@@ -203,66 +398,101 @@ def main():
     log = logging.getLogger("batch")
 
     # collect candidate FASTA files
+    split_dir  = out_dir / "split_seqs"
     fasta_ext = {".fa", ".fna", ".fasta", ".fas"}
-    fastas = sorted(
-        f for f in in_dir.rglob("*")
-        if f.suffix.lower() in fasta_ext
-        and (a.include is None or any(kw.lower() in f.name.lower() for kw in a.include)))
+    match = keyword_matcher(a.include)
+    fastas = []
+    for root, dirs, files in os.walk(in_dir):    # no stat() per entry
+        # never descend into our own output (results …, split_seqs/ even
+        # when out_dir == in_dir)
+        dirs[:] = [d for d in dirs if Path(root, d) not in (out_dir, split_dir)]
+        fastas.extend(
+            Path(root) / name for name in files
+            if os.path.splitext(name)[1].lower() in fasta_ext
+            and match(name))
+    fastas.sort()
 
     if not fastas:
         sys.exit("> No matching FASTA files found.")
 
+    if a.blast_script is not None:
+        log.warning("> --blast_script is deprecated and ignored; "
+                    "blast_remote.run_one is called directly")
+
     log.info("Found %d FASTA files", len(fastas))
 
-    split_dir  = out_dir / "split_seqs"
     split_map  = {}                              # {fasta: [Path, Path, …]}
     for fa in fastas:
         split_map[fa] = split_multifasta(fa, split_dir)
 
-    seq_total = sum(len(v) for v in split_map.values())
+    queue = [(fa, q) for fa, qs in split_map.items() for q in qs]
+    seq_total = len(queue)
     log.info("Total sequences to BLAST: %d", seq_total)
 
     t_batch0 = time.perf_counter()
-    seq_done = 0
 
     if a.sleep >= 10:
-        time_to_sleep = str(a.sleep)
+        time_to_sleep = a.sleep
     else:
-        time_to_sleep = "10"
+        time_to_sleep = 10
         log.info("> Delay should be atleast 10 sec!")
-    
-    for fa in fastas:
-        for q in split_multifasta(fa, out_dir / "split_seqs"):
-            if done_already(q, out_dir):
-                seq_done += 1
-                log.info("> (%d/%d) %-35s  (already done)",
-                         seq_done, seq_total, q.name)
-                continue
-
-            seq_done += 1
-            log.info("> (%d/%d) BLAST %s", seq_done, seq_total, q.name)
-
-            cmd = [
-                sys.executable, str(blast_script), str(q),         
-                "-d", a.db,
-                "-o", str(out_dir),
-                "-t", a.task,
-                "--sleep", time_to_sleep
-            ]
-
-            if a.filter:                                 
-                cmd.extend(["-f", a.filter])
-            
-            if a.filter_name:
-                cmd.extend(["-n", a.filter_name])
-
-            try:
-                subprocess.run(cmd, check=True)
-            except subprocess.CalledProcessError as e:
-                log.error(">  %s failed (exit %d)", q.name, e.returncode)
-                continue
-            log.info(">  %s done", q.name)
 
+    result_ext = ".tsv" if a.combined_xlsx else ".xlsx"
+    finished = done_stems(out_dir, result_ext, a.filter_name)
+    pending = []                                 # [(idx, Path)] still to BLAST
+    for idx, (_, q) in enumerate(queue, 1):
+        if done_already(q, finished):
+            log.info("> (%d/%d) %-35s  (already done)",
+                     idx, seq_total, q.name)
+            continue
+        pending.append((idx, q))
+
+    def run_job(idx: int, q: Path):
+        # stagger the start so parallel jobs don't hit NCBI all at once
+        time.sleep(random.uniform(0, time_to_sleep))
+        log.info("> (%d/%d) BLAST %s", idx, seq_total, q.name)
+
+        try:
+            blast_remote.run_one(
+                q, db=a.db, task=a.task, outdir=out_dir,
+                filter=a.filter or None, filter_name=a.filter_name,
+                sleep=time_to_sleep, rest=a.rest,
+                no_xlsx=bool(a.combined_xlsx))   # workbook is written at the end
+        except (blast_remote.BlastError, OSError) as e:
+            log.error(">  %s failed (%s)", q.name, e)
+            return
+        except Exception:
+            # any other error (parser, XLSX writer …) only fails this query,
+            # as the old one-subprocess-per-query design did
+            log.exception(">  %s failed", q.name)
+            return
+        finished.add(q.stem.split(".")[0])
+        log.info(">  %s done", q.name)
+
+    with ThreadPoolExecutor(max_workers=a.jobs) as pool:
+        futures = [pool.submit(run_job, idx, q) for idx, q in pending]
+        try:
+            not_done = futures                   # run_job logs its own failures
+            while not_done:                      # short waits keep Ctrl-C responsive
+                _, not_done = wait(not_done, timeout=1)
+        except KeyboardInterrupt:
+            # drop the queued jobs; only the ones already running finish
+            log.warning("> Interrupted, cancelling queued jobs …")
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    if a.combined_xlsx:
+        tsvs, used = find_results(out_dir, ".tsv", a.filter_name), set()
+        sheets = [(sheet_name(q.stem, used), tsvs[q.stem.split(".")[0]])
+                  for _, q in queue
+                  if q.stem.split(".")[0] in tsvs]
+        xlsx = Path(a.combined_xlsx).expanduser().resolve()
+        try:
+            write_combined_xlsx(sheets, xlsx)
+        except Exception:                        # TSVs are kept either way
+            log.exception("> Combined workbook %s failed", xlsx)
+        else:
+            log.info("> Combined workbook (%d sheets) → %s", len(sheets), xlsx)
 
     log.info("> All jobs finished in %s", human(time.perf_counter()-t_batch0))
     log.info("Log saved to %s", log_path)